@@ -1,36 +1,89 @@
-from typing import Dict, Tuple, Optional
+from typing import Any, Dict, List, Mapping, Tuple, Optional
+import os
+import functools
+import collections.abc
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
 import tarfile
 import logging
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pathlib import Path
-from collections import defaultdict
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
 
 from depccg.types import GrammarConfig, ModelConfig
-from depccg.chainer.supertagger import load_chainer_tagger
-from depccg.allennlp.supertagger import load_allennlp_tagger
 from depccg.lang import get_global_language
-from depccg.grammar import en, ja
 
 logger = logging.getLogger(__name__)
 
 MODEL_DIRECTORY = Path(__file__).parent / 'models'
 
+CHUNK_SIZE = 1 << 20
+
+NUM_DOWNLOAD_WORKERS = 8
+
+# (connect, read) timeouts in seconds
+TIMEOUT = (5, 60)
+
+# shared by all downloads so that connections to the server are reused
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=NUM_DOWNLOAD_WORKERS,
+    max_retries=Retry(total=3, backoff_factor=0.5),
+))
+
+# (model name, device) -> (mtime of the model files, supertagger, config)
+_MODEL_CACHE: Dict[Tuple[str, int], Tuple[float, Any, ModelConfig]] = {}
+_MODEL_CACHE_LOCK = threading.Lock()
+# one lock per cache key, so that a model is loaded once even when it is
+# requested from several threads, without blocking lookups of other models
+_MODEL_LOAD_LOCKS: Dict[Tuple[str, int], threading.Lock] = {}
+
 
 SEMANTIC_TEMPLATES: Dict[str, Path] = {
     'en': MODEL_DIRECTORY / 'semantic_templates_en_event.yaml',
     'ja': MODEL_DIRECTORY / 'semantic_templates_ja_event.yaml'
 }
 
-GRAMMARS: Dict[str, GrammarConfig] = {
-    'en': GrammarConfig(
-        en.apply_binary_rules,
-        en.apply_unary_rules,
-    ),
-    'ja': GrammarConfig(
-        ja.apply_binary_rules,
-        ja.apply_unary_rules,
+@functools.lru_cache(maxsize=None)
+def _get_grammar(lang: str) -> GrammarConfig:
+    if lang == 'en':
+        from depccg.grammar import en as grammar
+    elif lang == 'ja':
+        from depccg.grammar import ja as grammar
+    else:
+        raise KeyError(lang)
+    return GrammarConfig(
+        grammar.apply_binary_rules,
+        grammar.apply_unary_rules,
     )
-}
+
+
+class _LazyGrammars(collections.abc.Mapping):
+    """a read-only mapping from languages to their GrammarConfig,
+    importing each grammar module on first access.
+    """
+
+    _languages = ('en', 'ja')
+
+    def __getitem__(self, lang: str) -> GrammarConfig:
+        return _get_grammar(lang)
+
+    def __iter__(self):
+        return iter(self._languages)
+
+    def __len__(self) -> int:
+        return len(self._languages)
+
+
+GRAMMARS: Mapping[str, GrammarConfig] = _LazyGrammars()
 
 MODELS: Dict[str, ModelConfig] = {
     'en': ModelConfig(
@@ -71,11 +124,9 @@ MODELS: Dict[str, ModelConfig] = {
 }
 
 
-def _lang_and_variant(model: str):
-    if '[' in model and ']' in model:
-        assert model[-1] == ']'
-        return model[:-1].split('[')
-    return model, None
+def _lang_and_variant(model: str) -> Tuple[str, Optional[str]]:
+    lang, sep, rest = model.partition('[')
+    return (lang, rest[:-1]) if sep else (model, None)
 
 
 def _get_model_name(variant: Optional[str]) -> str:
@@ -85,10 +136,290 @@ def _get_model_name(variant: Optional[str]) -> str:
     return f'{lang}[{variant}]'
 
 
-AVAILABLE_MODEL_VARIANTS = defaultdict(list)
-for model in MODELS:
-    lang, variant = _lang_and_variant(model)
-    AVAILABLE_MODEL_VARIANTS[lang].append(variant)
+def _available_model_variants() -> Mapping[str, Tuple[Optional[str], ...]]:
+    variants: Dict[str, List[Optional[str]]] = {}
+    for model in MODELS:
+        lang, variant = _lang_and_variant(model)
+        variants.setdefault(lang, []).append(variant)
+    return MappingProxyType({
+        lang: tuple(items) for lang, items in variants.items()
+    })
+
+
+AVAILABLE_MODEL_VARIANTS = _available_model_variants()
+
+
+class _HashingReader:
+    """wraps a file object, feeding everything read from it into a hash."""
+
+    def __init__(self, fileobj, hasher):
+        self.fileobj = fileobj
+        self.hasher = hasher
+        self.size = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.fileobj.read(size)
+        self.hasher.update(data)
+        self.size += len(data)
+        return data
+
+
+def _part_path(filename: Path) -> Path:
+    return filename.with_name(filename.name + '.part')
+
+
+def _file_sha256(filename: Path) -> str:
+    hasher = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _expected_length(response: requests.Response) -> Optional[int]:
+    # with a content encoding, Content-Length counts the encoded bytes
+    if response.headers.get('Content-Encoding', 'identity') != 'identity':
+        return None
+    length = response.headers.get('Content-Length', '')
+    return int(length) if length.isdigit() else None
+
+
+def _check_length(actual: int, expected: Optional[int], what: str) -> None:
+    if expected is not None and actual != expected:
+        raise RuntimeError(
+            f'incomplete download of {what}: got {actual} of {expected} bytes'
+        )
+
+
+def _check_sha256(actual: str, expected: Optional[str], what: str) -> None:
+    if expected is not None and actual != expected.lower():
+        raise RuntimeError(
+            f'checksum mismatch for {what}: expected {expected}, got {actual}'
+        )
+
+
+def _download_stream(
+    url: str,
+    params: Dict[str, str],
+    filename: Path,
+    sha256: Optional[str] = None,
+) -> str:
+    part = _part_path(filename)
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        with _SESSION.get(
+            url, params=params, stream=True, timeout=TIMEOUT
+        ) as response:
+            response.raise_for_status()
+            expected_size = _expected_length(response)
+            with open(part, "wb") as f:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    if chunk:
+                        f.write(chunk)
+                        hasher.update(chunk)
+                        size += len(chunk)
+        _check_length(size, expected_size, filename.name)
+        _check_sha256(hasher.hexdigest(), sha256, filename.name)
+    except BaseException:
+        if part.exists():
+            part.unlink()
+        raise
+    os.replace(part, filename)
+    return hasher.hexdigest()
+
+
+def _download_and_extract(
+    url: str,
+    params: Dict[str, str],
+    directory: Path,
+    sha256: Optional[str] = None,
+) -> str:
+    # 'r|gz' reads the archive sequentially, so entries are extracted
+    # as they arrive without writing the .tar.gz to disk first. They go
+    # to a staging directory and are moved into place only once the
+    # checksum of the whole archive has been verified.
+    staging = Path(tempfile.mkdtemp(prefix='.part-', dir=directory))
+    hasher = hashlib.sha256()
+    try:
+        with _SESSION.get(
+            url, params=params, stream=True, timeout=TIMEOUT
+        ) as response:
+            response.raise_for_status()
+            expected_size = _expected_length(response)
+            response.raw.decode_content = True
+            reader = _HashingReader(response.raw, hasher)
+            with tarfile.open(fileobj=reader, mode='r|gz') as tf:
+                if hasattr(tarfile, 'data_filter'):
+                    tf.extractall(staging, filter='data')
+                else:
+                    tf.extractall(staging)
+            # hash whatever trails the end-of-archive marker as well
+            while reader.read(CHUNK_SIZE):
+                pass
+        _check_length(reader.size, expected_size, 'the downloaded archive')
+        _check_sha256(hasher.hexdigest(), sha256, 'the downloaded archive')
+
+        for entry in staging.iterdir():
+            target = directory / entry.name
+            if target.is_dir():
+                shutil.rmtree(target)
+            os.replace(entry, target)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    return hasher.hexdigest()
+
+
+def _ranged_size(remote: Dict[str, Optional[str]]) -> Optional[int]:
+    """returns the size of the file if the server (as seen in the metadata
+    from _remote_metadata) accepts byte-range requests, otherwise None, in
+    which case the file should be fetched as a single stream.
+    """
+    if remote.get('accept_ranges') != 'bytes':
+        return None
+    length = remote.get('content_length') or ''
+    return int(length) if length.isdigit() else None
+
+
+def _fetch_range(
+    url: str, params: Dict[str, str], fd: int, start: int, end: int
+) -> None:
+    headers = {'Range': f'bytes={start}-{end}'}
+    with _SESSION.get(
+        url, params=params, headers=headers, stream=True, timeout=TIMEOUT
+    ) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise RuntimeError(
+                f'the server ignored the range request: bytes={start}-{end}'
+            )
+        content_range = response.headers.get('Content-Range', '')
+        if not content_range.startswith(f'bytes {start}-{end}/'):
+            raise RuntimeError(
+                f'the server answered bytes={start}-{end} '
+                f'with a different range: {content_range!r}'
+            )
+        offset = start
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            if chunk:
+                os.pwrite(fd, chunk, offset)
+                offset += len(chunk)
+    if offset != end + 1:
+        raise RuntimeError(
+            f'incomplete download of bytes={start}-{end}: got {offset - start} bytes'
+        )
+
+
+def _download_ranges(
+    url: str,
+    params: Dict[str, str],
+    filename: Path,
+    total_size: int,
+    sha256: Optional[str] = None,
+    num_workers: int = NUM_DOWNLOAD_WORKERS,
+) -> str:
+    step = max(-(-total_size // num_workers), 1)
+    ranges = [
+        (start, min(start + step, total_size) - 1)
+        for start in range(0, total_size, step)
+    ]
+    part = _part_path(filename)
+    try:
+        fd = os.open(part, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, total_size)
+            with ThreadPoolExecutor(max_workers=max(len(ranges), 1)) as executor:
+                futures = [
+                    executor.submit(_fetch_range, url, params, fd, start, end)
+                    for start, end in ranges
+                ]
+                for future in futures:
+                    future.result()
+        finally:
+            os.close(fd)
+        # every range has been checked for its length by _fetch_range. The
+        # ranges arrive out of order, so the file is hashed afterwards
+        digest = _file_sha256(part)
+        _check_sha256(digest, sha256, filename.name)
+    except BaseException:
+        if part.exists():
+            part.unlink()
+        raise
+    os.replace(part, filename)
+    return digest
+
+
+def _local_model_path(config: ModelConfig) -> Path:
+    model_path = MODEL_DIRECTORY / config.name
+    if config.framework == 'allennlp':
+        model_path = model_path.with_suffix('.tar.gz')
+    return model_path
+
+
+def _metadata_path(config: ModelConfig) -> Path:
+    return MODEL_DIRECTORY / f'{config.name}.meta.json'
+
+
+def _extracted_marker_path(config: ModelConfig) -> Path:
+    return MODEL_DIRECTORY / f'{config.name}.extracted'
+
+
+def _is_usable_on_disk(config: ModelConfig) -> bool:
+    model_path = _local_model_path(config)
+    if not model_path.exists():
+        return False
+    if config.framework != 'chainer':
+        return True
+    # models extracted before the marker was introduced have none, so also
+    # accept a directory holding the files load_chainer_tagger reads
+    return (
+        _extracted_marker_path(config).exists()
+        or all(
+            (model_path / name).is_file()
+            for name in ['tagger_model', 'tagger_defs.txt']
+        )
+    )
+
+
+_NO_REMOTE_METADATA: Dict[str, Optional[str]] = {
+    'etag': None, 'content_length': None, 'accept_ranges': None,
+}
+
+
+def _remote_metadata(url: str, params: Dict[str, str]) -> Dict[str, Optional[str]]:
+    response = _SESSION.head(
+        url, params=params, allow_redirects=True, timeout=TIMEOUT
+    )
+    response.raise_for_status()
+    return {
+        'etag': response.headers.get('ETag'),
+        'content_length': response.headers.get('Content-Length'),
+        'accept_ranges': response.headers.get('Accept-Ranges'),
+    }
+
+
+def _read_local_metadata(config: ModelConfig) -> Optional[Dict[str, Any]]:
+    try:
+        with open(_metadata_path(config)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _is_up_to_date(
+    config: ModelConfig, remote: Dict[str, Optional[str]]
+) -> bool:
+    if remote['etag'] is None and remote['content_length'] is None:
+        return False
+    local = _read_local_metadata(config)
+    if local is None:
+        return False
+    if (
+        local.get('etag') != remote['etag']
+        or local.get('content_length') != remote['content_length']
+    ):
+        return False
+    return _is_usable_on_disk(config)
 
 
 def download(lang: str, variant: Optional[str]) -> None:
@@ -99,14 +430,45 @@ def download(lang: str, variant: Optional[str]) -> None:
     
     query_parameters = {"downloadformat" : "tar.gz"}
     url = f"https://drive.google.com/uc?export=download&id={config.url}&confirm=yes"
-    response = requests.get(url, params=query_parameters)
-    with open(filename, "wb") as f:
-        f.write(response.content)
+
+    try:
+        remote = _remote_metadata(url, query_parameters)
+    except (requests.ConnectionError, requests.Timeout):
+        if _is_usable_on_disk(config):
+            logging.warning(
+                'could not reach the server; using the model found on disk')
+            return
+        remote = dict(_NO_REMOTE_METADATA)
+    except requests.RequestException as e:
+        # e.g. servers rejecting HEAD; the download itself may still work
+        logging.info(f'could not fetch the model metadata: {e}')
+        remote = dict(_NO_REMOTE_METADATA)
+
+    if _is_up_to_date(config, remote):
+        logging.info('the model is up to date')
+        return
 
     if config.framework == 'chainer':
         logging.info('extracting files')
-        tf = tarfile.open(filename)
-        tf.extractall(MODEL_DIRECTORY)
+        # the old model stays in place if this fails, so the marker is only
+        # updated once the new one has been extracted
+        digest = _download_and_extract(
+            url, query_parameters, MODEL_DIRECTORY, config.sha256
+        )
+        _extracted_marker_path(config).touch()
+    else:
+        total_size = _ranged_size(remote)
+        if total_size is not None and hasattr(os, 'pwrite'):
+            digest = _download_ranges(
+                url, query_parameters, filename, total_size, config.sha256
+            )
+        else:
+            digest = _download_stream(
+                url, query_parameters, filename, config.sha256
+            )
+
+    with open(_metadata_path(config), 'w') as f:
+        json.dump(dict(remote, sha256=digest, last_sync=time.time()), f)
     logging.info('finished')
 
 
@@ -114,9 +476,7 @@ def load_model_directory(
     variant: Optional[str]
 ) -> Tuple[Path, ModelConfig]:
     config = MODELS[_get_model_name(variant)]
-    model_path = MODEL_DIRECTORY / config.name
-    if config.framework == 'allennlp':
-        model_path = model_path.with_suffix('.tar.gz')
+    model_path = _local_model_path(config)
     if not model_path.exists():
         if variant is None:
             variant = ''
@@ -129,19 +489,59 @@ def load_model_directory(
 
 
 def model_is_available(model_name: str) -> bool:
-    return model_name in MODELS.keys()
+    return model_name in MODELS
+
+
+def _model_mtime(model_path: Path) -> float:
+    # chainer models are directories whose own mtime does not change when the
+    # files the loader reads (tagger_model, tagger_defs.txt, ...) are replaced
+    if model_path.is_dir():
+        return max(
+            (path.stat().st_mtime for path in model_path.rglob('*') if path.is_file()),
+            default=model_path.stat().st_mtime,
+        )
+    return model_path.stat().st_mtime
 
 
 def load_model(variant: Optional[str], device: int = -1):
     model_path, config = load_model_directory(variant)
-    if config.framework == 'allennlp':
-        supertagger = load_allennlp_tagger(model_path, device)
-    elif config.framework == 'chainer':
-        supertagger = load_chainer_tagger(model_path, device)
-    else:
-        lang = get_global_language()
-        raise KeyError(
-            ('unsupported model for language '
-             f'({lang}): {variant}')
-        )
+    # the model name (not the variant) distinguishes e.g. 'en' from 'ja'
+    key = (_get_model_name(variant), device)
+    mtime = _model_mtime(model_path)
+
+    def lookup():
+        with _MODEL_CACHE_LOCK:
+            cached = _MODEL_CACHE.get(key)
+        if cached is not None and cached[0] == mtime:
+            return cached[1:]
+        return None
+
+    cached = lookup()
+    if cached is not None:
+        return cached
+
+    with _MODEL_CACHE_LOCK:
+        load_lock = _MODEL_LOAD_LOCKS.setdefault(key, threading.Lock())
+
+    with load_lock:
+        # another thread may have loaded the model while we were waiting
+        cached = lookup()
+        if cached is not None:
+            return cached
+
+        # import lazily so that only the framework in use gets loaded
+        if config.framework == 'allennlp':
+            from depccg.allennlp.supertagger import load_allennlp_tagger
+            supertagger = load_allennlp_tagger(model_path, device)
+        elif config.framework == 'chainer':
+            from depccg.chainer.supertagger import load_chainer_tagger
+            supertagger = load_chainer_tagger(model_path, device)
+        else:
+            lang = get_global_language()
+            raise KeyError(
+                ('unsupported model for language '
+                 f'({lang}): {variant}')
+            )
+        with _MODEL_CACHE_LOCK:
+            _MODEL_CACHE[key] = (mtime, supertagger, config)
     return supertagger, config
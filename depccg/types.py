@@ -86,3 +86,4 @@ class ModelConfig(NamedTuple):
     url: str
     config: Path
     semantic_templates: Path
+    sha256: Optional[str] = None
@@ -1,13 +1,13 @@
 from setuptools import Extension, setup, find_packages
 import sys
 import os
+import shutil
+import platform
 import sysconfig
-import contextlib
-import subprocess
 
 
 try:
-    from Cython.Build import build_ext
+    from Cython.Build import build_ext, cythonize
 except ImportError:
     sys.exit("""\
 Could not import Cython, which is required to build depccg extension modules.
@@ -25,52 +25,69 @@ Please install cython and numpy prior to installing depccg.\
 here = os.path.abspath(os.path.dirname(__file__))
 
 
-install_requires = [
-    line.strip() for line in open(
-        os.path.join(here, 'requirements.txt'))
-]
+def env_flag(name):
+    """build toggles are on for 1/true/yes/on and off otherwise (including 0)"""
+    return os.environ.get(name, '').strip().lower() in ('1', 'true', 'yes', 'on')
 
-with open(os.path.join(here, 'README.md'), encoding='utf-8') as f:
-    long_description = f.read()
 
+COMPILER_CACHES = ('ccache', 'sccache')
 
-@contextlib.contextmanager
-def chdir(new_dir):
-    old_dir = os.getcwd()
-    try:
-        os.chdir(new_dir)
-        sys.path.insert(0, new_dir)
-        yield
-    finally:
-        del sys.path[0]
-        os.chdir(old_dir)
 
+# Route the compilers through ccache (or sccache) when one is available, so
+# that rebuilding unchanged sources is served from the cache. Set
+# DEPCCG_NO_CCACHE=1 to disable this, or set the compilers by hand instead,
+# e.g. CC="ccache gcc" CXX="ccache g++" pip install depccg
+def use_compiler_cache():
+    if env_flag('DEPCCG_NO_CCACHE'):
+        return
+    wrapper = next(filter(None, map(shutil.which, COMPILER_CACHES)), None)
+    if wrapper is None:
+        return
+    for var, default in [('CC', 'cc'), ('CXX', 'c++')]:
+        compiler = (
+            os.environ.get(var)
+            or sysconfig.get_config_var(var)
+            or default
+        )
+        first, *_ = compiler.split() or ['']
+        if os.path.basename(first) not in COMPILER_CACHES:
+            os.environ[var] = f'{wrapper} {compiler}'
 
-def clean():
-    depccg_dir = os.path.join(here, 'depccg')
-    for name in os.listdir(depccg_dir):
-        file_path = os.path.join(depccg_dir, name)
-        if any(file_path.endswith(ext) for ext in ['.so', '.cpp', '.c']):
-            os.unlink(file_path)
-    with chdir('c'):
-        subprocess.call(["make", "clean"], env=os.environ)
 
+use_compiler_cache()
+
+
+install_requires = [
+    line.strip() for line in open(
+        os.path.join(here, 'requirements.txt'))
+]
 
-def generate_cpp(options):
-    options = ' '.join(options)
-    options = f'OPTIONS={options}'
-    with chdir('c'):
-        p = subprocess.call(["make", options], env=os.environ)
-        if p != 0:
-            raise RuntimeError('Running cythonize failed')
+with open(os.path.join(here, 'README.md'), encoding='utf-8') as f:
+    long_description = f.read()
 
 
 COMPILE_OPTIONS = [
     '-O3',
     '-Wall',
-    '-std=c++11'
+    '-std=c++17'
 ]
 
+# DEPCCG_NATIVE=1 tunes the build for the host CPU (not redistributable);
+# DEPCCG_PORTABLE=1 targets x86-64-v3 (AVX2, FMA, BMI2), e.g. for wheels,
+# which requires GCC >= 11 or Clang >= 12.
+if env_flag('DEPCCG_NATIVE'):
+    COMPILE_OPTIONS += [
+        '-march=native',
+        '-mtune=native',
+        '-ffast-math',
+        '-funroll-loops',
+    ]
+elif (
+    env_flag('DEPCCG_PORTABLE')
+    and platform.machine().lower() in ('x86_64', 'amd64')
+):
+    COMPILE_OPTIONS.append('-march=x86-64-v3')
+
 LINK_OPTIONS = []
 
 if sys.platform == 'darwin':
@@ -80,14 +97,30 @@ if sys.platform == 'darwin':
     # See: https://stackoverflow.com/questions/1653047/avoid-linking-to-libstdc
     LINK_OPTIONS.append('-nodefaultlibs')
 
+# number of worker processes used to translate .pyx files into C++
+NTHREADS = int(os.environ.get('DEPCCG_NTHREADS', os.cpu_count() or 1))
+
+# number of parallel jobs used to compile the generated C++ sources
+BUILD_JOBS = int(os.environ.get('DEPCCG_BUILD_JOBS', os.cpu_count() or 1))
+
+# morpha.c is plain C, so it is built as a static library by build_clib
+# and linked into the depccg.morpha extension.
+libraries = [
+    ('morpha', {
+        'sources': ['c/morpha.c'],
+        'include_dirs': ['c'],
+        'cflags': ['-O3'],
+    })
+]
+
 ext_modules = [
     Extension(
         'depccg.morpha',
         ['depccg/morpha.pyx'],
         language='c++',
         extra_compile_args=COMPILE_OPTIONS,
-        extra_link_args=LINK_OPTIONS + ['c/morpha.o'],
-        include_dirs=['.', 'c']
+        extra_link_args=LINK_OPTIONS,
+        include_dirs=['.', 'c'],
     ),
     Extension(
         'depccg._parsing',
@@ -116,16 +149,37 @@ def get_ext_filename_without_platform_suffix(filename):
         return name[:idx] + ext
     
 class BuildExtWithoutPlatformSuffix(build_ext):
+    def finalize_options(self):
+        super().finalize_options()
+        if not self.parallel:
+            self.parallel = BUILD_JOBS
+        # cythonize here rather than at import time, so that commands such
+        # as clean or egg_info do not translate the .pyx files
+        self.extensions = cythonize(
+            self.extensions,
+            nthreads=NTHREADS,
+            language_level=3,
+            compiler_directives={
+                'boundscheck': False,
+                'wraparound': False,
+                'cdivision': True,
+            },
+        )
+
+    def run(self):
+        # build_ext alone (e.g. --inplace) does not build the C libraries
+        if self.distribution.has_c_libraries():
+            self.run_command('build_clib')
+        super().run()
+
     def get_ext_filename(self, ext_name):
         filename = super().get_ext_filename(ext_name)
         return get_ext_filename_without_platform_suffix(filename)
 
 
-if len(sys.argv) > 1 and sys.argv[1] == 'clean':
-    clean()
-else:
-    generate_cpp([])
-
+# the guard keeps cythonize's worker processes, which re-import this file
+# when started by spawn (macOS, Windows), from running setup() again
+if __name__ == '__main__':
     setup(
         name="depccg",
         version="2.0.3",  # NOQA
@@ -147,5 +201,6 @@ else:
         ],
         zip_safe=False,
         cmdclass={'build_ext': BuildExtWithoutPlatformSuffix},
+        libraries=libraries,
         ext_modules=ext_modules
     )
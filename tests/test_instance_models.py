@@ -0,0 +1,419 @@
+import io
+import os
+import sys
+import subprocess
+import json
+import types
+import hashlib
+import tarfile
+import threading
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import depccg.lang
+import depccg.instance_models as instance_models
+from depccg.types import ModelConfig
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.server.data)))
+        self.send_header('ETag', self.server.etag)
+        if self.server.accept_ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_GET(self):
+        data = self.server.data
+        range_header = self.headers.get('Range')
+        if range_header is None or not self.server.accept_ranges:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        start, end = map(int, range_header[len('bytes='):].split('-'))
+        start += self.server.shift_ranges
+        end = min(end + self.server.shift_ranges, len(data) - 1)
+        body = data[start:end + 1]
+        if self.server.truncate_ranges and len(body) > 1:
+            body = body[:len(body) // 2]
+        self.send_response(206)
+        self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture()
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+    httpd.data = os.urandom(3 * instance_models.CHUNK_SIZE + 12345)
+    httpd.etag = '"v1"'
+    httpd.accept_ranges = True
+    httpd.truncate_ranges = False
+    httpd.shift_ranges = 0
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.url = f'http://127.0.0.1:{httpd.server_address[1]}/model.tar.gz'
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_ranged_size(server):
+    remote = instance_models._remote_metadata(server.url, {})
+    assert instance_models._ranged_size(remote) == len(server.data)
+
+    server.accept_ranges = False
+    remote = instance_models._remote_metadata(server.url, {})
+    assert instance_models._ranged_size(remote) is None
+    assert instance_models._ranged_size(instance_models._NO_REMOTE_METADATA) is None
+
+
+def test_download_ranges(server, tmp_path):
+    filename = tmp_path / 'model.tar.gz'
+    instance_models._download_ranges(server.url, {}, filename, len(server.data))
+    assert filename.read_bytes() == server.data
+    assert list(tmp_path.iterdir()) == [filename]
+
+
+def test_download_falls_back_to_single_stream(server, tmp_path):
+    server.accept_ranges = False
+    filename = tmp_path / 'model.tar.gz'
+    instance_models._download_stream(server.url, {}, filename)
+    assert filename.read_bytes() == server.data
+    assert list(tmp_path.iterdir()) == [filename]
+
+
+def test_download_ranges_rejects_ignored_range(server, tmp_path):
+    filename = tmp_path / 'model.tar.gz'
+    server.accept_ranges = False
+    with pytest.raises(RuntimeError, match='ignored the range request'):
+        instance_models._download_ranges(server.url, {}, filename, len(server.data))
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_incomplete_range(server, tmp_path):
+    server.truncate_ranges = True
+    filename = tmp_path / 'model.tar.gz'
+    with pytest.raises(RuntimeError, match='incomplete download'):
+        instance_models._download_ranges(server.url, {}, filename, len(server.data))
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_mismatched_content_range(server, tmp_path):
+    server.shift_ranges = 1
+    filename = tmp_path / 'model.tar.gz'
+    with pytest.raises(RuntimeError, match='different range'):
+        instance_models._download_ranges(server.url, {}, filename, len(server.data))
+    assert list(tmp_path.iterdir()) == []
+
+
+def make_archive(name: str, content: bytes) -> bytes:
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tf:
+        info = tarfile.TarInfo(f'{name}/tagger_model')
+        info.size = len(content)
+        tf.addfile(info, io.BytesIO(content))
+    return buf.getvalue()
+
+
+def test_download_and_extract(server, tmp_path):
+    (tmp_path / 'tri_headfirst').mkdir()
+    (tmp_path / 'tri_headfirst' / 'tagger_model').write_bytes(b'old weights')
+    server.data = make_archive('tri_headfirst', b'new weights')
+
+    instance_models._download_and_extract(server.url, {}, tmp_path)
+    assert (tmp_path / 'tri_headfirst' / 'tagger_model').read_bytes() == b'new weights'
+    assert [path.name for path in tmp_path.iterdir()] == ['tri_headfirst']
+
+
+@pytest.mark.parametrize('ranged', [True, False])
+def test_download_records_digest(server, tmp_path, ranged):
+    server.accept_ranges = ranged
+    filename = tmp_path / 'model.tar.gz'
+    expected = hashlib.sha256(server.data).hexdigest()
+    if ranged:
+        digest = instance_models._download_ranges(
+            server.url, {}, filename, len(server.data))
+    else:
+        digest = instance_models._download_stream(server.url, {}, filename)
+    assert digest == expected
+
+    # a matching checksum is accepted
+    if ranged:
+        instance_models._download_ranges(
+            server.url, {}, filename, len(server.data), expected)
+    else:
+        instance_models._download_stream(server.url, {}, filename, expected)
+    assert filename.read_bytes() == server.data
+
+
+@pytest.mark.parametrize('ranged', [True, False])
+def test_checksum_mismatch(server, tmp_path, ranged):
+    server.accept_ranges = ranged
+    filename = tmp_path / 'model.tar.gz'
+    with pytest.raises(RuntimeError, match='checksum mismatch'):
+        if ranged:
+            instance_models._download_ranges(
+                server.url, {}, filename, len(server.data), '0' * 64)
+        else:
+            instance_models._download_stream(server.url, {}, filename, '0' * 64)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_download_and_extract_keeps_directory_on_failure(server, tmp_path):
+    (tmp_path / 'tri_headfirst').mkdir()
+    (tmp_path / 'tri_headfirst' / 'tagger_model').write_bytes(b'old weights')
+    server.data = make_archive('tri_headfirst', b'new weights')
+
+    with pytest.raises(RuntimeError, match='checksum mismatch'):
+        instance_models._download_and_extract(server.url, {}, tmp_path, '0' * 64)
+    assert (tmp_path / 'tri_headfirst' / 'tagger_model').read_bytes() == b'old weights'
+    assert [path.name for path in tmp_path.iterdir()] == ['tri_headfirst']
+
+    digest = instance_models._download_and_extract(
+        server.url, {}, tmp_path, hashlib.sha256(server.data).hexdigest())
+    assert digest == hashlib.sha256(server.data).hexdigest()
+    assert (tmp_path / 'tri_headfirst' / 'tagger_model').read_bytes() == b'new weights'
+
+
+@pytest.fixture()
+def model_directory(tmp_path, monkeypatch):
+    monkeypatch.setattr(instance_models, 'MODEL_DIRECTORY', tmp_path)
+    return tmp_path
+
+
+def write_metadata(config, etag='"v1"', content_length='100'):
+    with open(instance_models._metadata_path(config), 'w') as f:
+        json.dump({'etag': etag, 'content_length': content_length}, f)
+
+
+def test_is_up_to_date(model_directory):
+    config = ModelConfig('allennlp', 'parser', 'id', Path('c'), Path('s'))
+    remote = {'etag': '"v1"', 'content_length': '100'}
+
+    assert not instance_models._is_up_to_date(config, remote)
+    (model_directory / 'parser.tar.gz').write_bytes(b'')
+    assert not instance_models._is_up_to_date(config, remote)
+    write_metadata(config)
+    assert instance_models._is_up_to_date(config, remote)
+    assert not instance_models._is_up_to_date(
+        config, {'etag': '"v2"', 'content_length': '100'})
+    assert not instance_models._is_up_to_date(
+        config, {'etag': None, 'content_length': None})
+
+
+def test_is_usable_on_disk_chainer(model_directory):
+    config = ModelConfig('chainer', 'tri_headfirst', 'id', Path('c'), Path('s'))
+    remote = {'etag': '"v1"', 'content_length': '100'}
+    model_path = model_directory / 'tri_headfirst'
+    model_path.mkdir()
+    write_metadata(config)
+
+    assert not instance_models._is_usable_on_disk(config)
+    assert not instance_models._is_up_to_date(config, remote)
+
+    # extracted by a version of download() without the marker
+    (model_path / 'tagger_model').write_bytes(b'')
+    (model_path / 'tagger_defs.txt').write_text('{}')
+    assert instance_models._is_usable_on_disk(config)
+    assert instance_models._is_up_to_date(config, remote)
+
+    (model_path / 'tagger_model').unlink()
+    instance_models._extracted_marker_path(config).touch()
+    assert instance_models._is_usable_on_disk(config)
+
+
+def test_failed_update_keeps_offline_fallback(model_directory, monkeypatch):
+    config = ModelConfig('chainer', 'tri_headfirst', 'id', Path('c'), Path('s'))
+    monkeypatch.setattr(instance_models, 'MODELS', {'en': config})
+    (model_directory / 'tri_headfirst').mkdir()
+    instance_models._extracted_marker_path(config).touch()
+    write_metadata(config)
+
+    def fail(*args, **kwargs):
+        raise requests.ConnectionError('unreachable')
+
+    monkeypatch.setattr(
+        instance_models, '_remote_metadata',
+        lambda url, params: {'etag': '"v2"', 'content_length': '100'})
+    monkeypatch.setattr(instance_models, '_download_and_extract', fail)
+    with pytest.raises(requests.ConnectionError):
+        instance_models.download('en', None)
+    assert instance_models._extracted_marker_path(config).exists()
+
+    # offline now: the model on disk is used as is
+    monkeypatch.setattr(instance_models, '_remote_metadata', fail)
+    instance_models.download('en', None)
+
+
+def test_download_without_metadata_when_head_fails(model_directory, monkeypatch):
+    config = ModelConfig('allennlp', 'parser', 'id', Path('c'), Path('s'))
+    monkeypatch.setattr(instance_models, 'MODELS', {'en': config})
+    downloads = []
+
+    def reject_head(url, params):
+        raise requests.HTTPError('405 Method Not Allowed')
+
+    def fake_stream(url, params, filename, sha256=None):
+        downloads.append(filename)
+        filename.write_bytes(b'')
+        return 'digest'
+
+    monkeypatch.setattr(instance_models, '_remote_metadata', reject_head)
+    monkeypatch.setattr(instance_models, '_download_stream', fake_stream)
+    instance_models.download('en', None)
+    assert downloads == [model_directory / 'parser.tar.gz']
+    with open(instance_models._metadata_path(config)) as f:
+        assert json.load(f)['sha256'] == 'digest'
+
+
+@pytest.fixture()
+def fake_loaders(model_directory, monkeypatch):
+    # calls: arguments the loaders were called with; hooks: framework ->
+    # function run inside the loader, e.g. to make it slow
+    fake = types.SimpleNamespace(calls=[], hooks={})
+
+    def make_loader(framework):
+        def loader(model_path, device):
+            fake.calls.append((model_path, device))
+            if framework in fake.hooks:
+                fake.hooks[framework]()
+            return object()
+        return loader
+
+    for framework in ['allennlp', 'chainer']:
+        module = types.ModuleType(f'depccg.{framework}.supertagger')
+        setattr(module, f'load_{framework}_tagger', make_loader(framework))
+        monkeypatch.setitem(sys.modules, module.__name__, module)
+
+    monkeypatch.setattr(instance_models, '_MODEL_CACHE', {})
+    monkeypatch.setattr(instance_models, '_MODEL_LOAD_LOCKS', {})
+    monkeypatch.setattr(instance_models, 'MODELS', {
+        'en': ModelConfig('chainer', 'tri_headfirst', 'id', Path('c'), Path('s')),
+        'en[elmo]': ModelConfig('allennlp', 'elmo', 'id', Path('c'), Path('s')),
+    })
+    monkeypatch.setattr(depccg.lang, 'GLOBAL_LANG_NAME', 'en')
+    return fake
+
+
+def test_load_model_cache(fake_loaders, model_directory):
+    (model_directory / 'elmo.tar.gz').write_bytes(b'')
+
+    tagger, _ = instance_models.load_model('elmo')
+    assert instance_models.load_model('elmo')[0] is tagger
+    assert len(fake_loaders.calls) == 1
+
+    assert instance_models.load_model('elmo', device=0)[0] is not tagger
+    assert len(fake_loaders.calls) == 2
+
+    stat = (model_directory / 'elmo.tar.gz').stat()
+    os.utime(model_directory / 'elmo.tar.gz', (stat.st_atime, stat.st_mtime + 10))
+    assert instance_models.load_model('elmo')[0] is not tagger
+    assert len(fake_loaders.calls) == 3
+
+
+def test_load_model_cache_watches_chainer_model_files(fake_loaders, model_directory):
+    model_file = model_directory / 'tri_headfirst' / 'tagger_model'
+    model_file.parent.mkdir()
+    model_file.write_bytes(b'')
+
+    tagger, _ = instance_models.load_model(None)
+    assert instance_models.load_model(None)[0] is tagger
+
+    directory_stat = model_file.parent.stat()
+    stat = model_file.stat()
+    os.utime(model_file, (stat.st_atime, stat.st_mtime + 10))
+    os.utime(model_file.parent, (directory_stat.st_atime, directory_stat.st_mtime))
+    assert instance_models.load_model(None)[0] is not tagger
+    assert len(fake_loaders.calls) == 2
+
+
+def test_load_model_does_not_block_other_models(fake_loaders, model_directory):
+    (model_directory / 'elmo.tar.gz').write_bytes(b'')
+    (model_directory / 'tri_headfirst').mkdir()
+    tagger, _ = instance_models.load_model('elmo')
+
+    started, release = threading.Event(), threading.Event()
+
+    def slow_load():
+        started.set()
+        release.wait(10)
+
+    fake_loaders.hooks['chainer'] = slow_load
+    thread = threading.Thread(target=instance_models.load_model, args=(None,))
+    thread.start()
+    try:
+        assert started.wait(10)
+        # served from the cache while the chainer model is still loading
+        result = []
+        lookup = threading.Thread(
+            target=lambda: result.append(instance_models.load_model('elmo')[0]))
+        lookup.start()
+        lookup.join(5)
+        assert result == [tagger]
+    finally:
+        release.set()
+        thread.join()
+    assert len(fake_loaders.calls) == 2
+
+
+def test_load_model_requires_download(fake_loaders):
+    with pytest.raises(RuntimeError, match='please download the model'):
+        instance_models.load_model('elmo')
+    assert fake_loaders.calls == []
+
+
+def test_grammars_are_loaded_lazily():
+    from depccg.grammar import en, ja
+    assert sorted(instance_models.GRAMMARS) == ['en', 'ja']
+    assert len(instance_models.GRAMMARS) == 2
+    assert instance_models.GRAMMARS['en'].apply_binary_rules is en.apply_binary_rules
+    assert instance_models.GRAMMARS['ja'].apply_unary_rules is ja.apply_unary_rules
+    assert instance_models.GRAMMARS['en'] is instance_models.GRAMMARS['en']
+    with pytest.raises(KeyError):
+        instance_models.GRAMMARS['fr']
+
+
+def test_import_does_not_load_frameworks():
+    code = (
+        'import sys, depccg.instance_models; '
+        'loaded = {"chainer", "allennlp", "torch", "depccg.grammar.en"} & set(sys.modules); '
+        'assert not loaded, loaded'
+    )
+    subprocess.run(
+        [sys.executable, '-c', code], check=True,
+        cwd=Path(__file__).resolve().parent.parent,
+    )
+
+
+@pytest.mark.parametrize('model, expect', [
+    ('en', ('en', None)),
+    ('ja', ('ja', None)),
+    ('en[elmo]', ('en', 'elmo')),
+    ('en[elmo_rebank]', ('en', 'elmo_rebank')),
+])
+def test_lang_and_variant(model, expect):
+    assert instance_models._lang_and_variant(model) == expect
+
+
+def test_available_model_variants():
+    variants = instance_models.AVAILABLE_MODEL_VARIANTS
+    assert dict(variants) == {
+        'en': (None, 'elmo', 'rebank', 'elmo_rebank'),
+        'ja': (None,),
+    }
+    with pytest.raises(TypeError):
+        variants['fr'] = ()
+    assert instance_models.model_is_available('en[rebank]')
+    assert not instance_models.model_is_available('en[bert]')